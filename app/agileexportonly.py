@@ -1,54 +1,119 @@
 #!/usr/bin/env python
 
+import asyncio
+import logging
+
 from configparser import ConfigParser
-from urllib import parse
+from datetime import datetime, timedelta, timezone
 
+import aiohttp
 import click
 import maya
-import requests
+import orjson
+
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+
+from ciso8601 import parse_datetime
 
 from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.client.write_api import WriteOptions
+
+
+log = logging.getLogger("octograph")
+
+MAX_CONCURRENT_REQUESTS = 8
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+
+
+async def fetch_page(session, semaphore, api_key, url, args):
+    async with semaphore:
+        for attempt in range(RETRY_TOTAL + 1):
+            async with session.get(
+                    url, params=args, auth=aiohttp.BasicAuth(api_key, '')
+            ) as response:
+                if response.status in RETRY_STATUSES \
+                        and attempt < RETRY_TOTAL:
+                    await asyncio.sleep(RETRY_BACKOFF_FACTOR * 2 ** attempt)
+                    continue
+                response.raise_for_status()
+                return orjson.loads(await response.read())
 
 
-def retrieve_paginated_data(
-        api_key, url, from_date, to_date, page=None
+async def retrieve_paginated_data_async(
+        api_key, url, from_date, to_date, page_size
 ):
     args = {
         'period_from': from_date,
         'period_to': to_date,
+        'page_size': page_size,
     }
-    if page:
-        args['page'] = page
-    response = requests.get(url, params=args, auth=(api_key, ''))
-    response.raise_for_status()
-    data = response.json()
-    results = data.get('results', [])
-    if data['next']:
-        url_query = parse.urlparse(data['next']).query
-        next_page = parse.parse_qs(url_query)['page'][0]
-        results += retrieve_paginated_data(
-            api_key, url, from_date, to_date, next_page
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENT_REQUESTS, keepalive_timeout=30
+    )
+    headers = {'Connection': 'keep-alive', 'Accept-Encoding': 'gzip'}
+    # only genuinely historical windows are served from the on-disk
+    # cache: a window reaching into the last hour or the future keeps
+    # changing as the next day's rates are published, and caching it
+    # would pin every same-day re-run to the first response. the sqlite
+    # busy timeout covers concurrent fetches sharing one cache file
+    cache_cutoff = datetime.now(timezone.utc) - timedelta(hours=1)
+    if parse_datetime(to_date) < cache_cutoff:
+        session = CachedSession(
+            cache=SQLiteBackend(
+                'octograph_cache', expire_after=86400,
+                allowed_methods=('GET',), timeout=30,
+            ),
+            connector=connector, headers=headers,
         )
+    else:
+        session = aiohttp.ClientSession(connector=connector, headers=headers)
+    async with session:
+        data = await fetch_page(session, semaphore, api_key, url, args)
+        results = data.get('results', [])
+        if data['next'] and results:
+            # total page count is known from the first page, so the
+            # remaining pages can be fetched concurrently
+            page_count = -(-data['count'] // len(results))
+            tasks = [
+                asyncio.create_task(fetch_page(
+                    session, semaphore, api_key, url, {**args, 'page': page}
+                ))
+                for page in range(2, page_count + 1)
+            ]
+            # append each page as it completes instead of holding every
+            # raw page payload until the gather resolves; ordering is
+            # irrelevant as every rate carries its own timestamp
+            for task in asyncio.as_completed(tasks):
+                page_data = await task
+                results.extend(page_data.get('results', []))
     return results
 
 
-def store_agilerates(connection, agile_data):
-
-    write_api = connection.write_api(write_options=SYNCHRONOUS)
+def retrieve_paginated_data(api_key, url, from_date, to_date,
+                            page_size=1500):
+    return asyncio.run(
+        retrieve_paginated_data_async(
+            api_key, url, from_date, to_date, page_size
+        )
+    )
 
-    points = []
-    for agile_rate in agile_data:
-        print(f"{agile_rate['valid_from']} -> {agile_rate['valid_to']}: {agile_rate['value_inc_vat']}")
-        points.append(Point("electricity").field("agile_rate", agile_rate['value_inc_vat']).time(agile_rate['valid_from']))
-        if (len(points) > 48):
-            write_api.write(bucket="energy", record=points)
-            points=[]
-    
-    write_api.write(bucket="energy", record=points)
 
-    
+def store_agilerates(connection, agile_data):
 
+    write_options = WriteOptions(
+        batch_size=5000, flush_interval=1000,
+        jitter_interval=200, retry_interval=5000,
+    )
+    with connection.write_api(write_options=write_options) as write_api:
+        for agile_rate in agile_data:
+            log.debug("%s -> %s: %s", agile_rate['valid_from'], agile_rate['valid_to'], agile_rate['value_inc_vat'])
+            point = Point("electricity").field("agile_rate", agile_rate['value_inc_vat']).time(agile_rate['valid_from'])
+            write_api.write(bucket="energy", record=point)
+    log.info("wrote %d agile rate points", len(agile_data))
 
 
 
@@ -60,7 +125,8 @@ def store_agilerates(connection, agile_data):
 )
 @click.option('--from-date', default='yesterday midnight', type=click.STRING)
 @click.option('--to-date', default='tomorrow midnight', type=click.STRING)
-def cmd(config_file, from_date, to_date):
+@click.option('--page-size', default=1500, type=click.INT)
+def cmd(config_file, from_date, to_date, page_size):
 
     config = ConfigParser()
     config.read(config_file)
@@ -83,7 +149,9 @@ def cmd(config_file, from_date, to_date):
         f'Retrieving Agile rates for {from_iso} until {to_iso}...',
         nl=False
     )
-    agile_rates = retrieve_paginated_data( api_key, agile_url, from_iso, to_iso)
+    agile_rates = retrieve_paginated_data(
+        api_key, agile_url, from_iso, to_iso, page_size
+    )
     click.echo(f' {len(agile_rates)} rates received.')
     store_agilerates(influx,  agile_rates)
 
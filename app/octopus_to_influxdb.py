@@ -1,139 +1,207 @@
 #!/usr/bin/env python
 
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
-from urllib import parse
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
 
+import aiohttp
 import click
 import maya
-import requests
+import orjson
+
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+
+from ciso8601 import parse_datetime
+
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import WriteOptions
+
+
+log = logging.getLogger("octograph")
 
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+MAX_CONCURRENT_REQUESTS = 8
 
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
 
-def retrieve_paginated_data(
-        api_key, url, from_date, to_date, page=None
+
+async def fetch_page(session, semaphore, api_key, url, args):
+    async with semaphore:
+        for attempt in range(RETRY_TOTAL + 1):
+            async with session.get(
+                    url, params=args, auth=aiohttp.BasicAuth(api_key, '')
+            ) as response:
+                if response.status in RETRY_STATUSES \
+                        and attempt < RETRY_TOTAL:
+                    await asyncio.sleep(RETRY_BACKOFF_FACTOR * 2 ** attempt)
+                    continue
+                response.raise_for_status()
+                return orjson.loads(await response.read())
+
+
+async def retrieve_paginated_data_async(
+        api_key, url, from_date, to_date, page_size
 ):
     args = {
         'period_from': from_date,
         'period_to': to_date,
+        'page_size': page_size,
     }
-    if page:
-        args['page'] = page
-    response = requests.get(url, params=args, auth=(api_key, ''))
-    response.raise_for_status()
-    data = response.json()
-    results = data.get('results', [])
-    if data['next']:
-        url_query = parse.urlparse(data['next']).query
-        next_page = parse.parse_qs(url_query)['page'][0]
-        results += retrieve_paginated_data(
-            api_key, url, from_date, to_date, next_page
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENT_REQUESTS, keepalive_timeout=30
+    )
+    headers = {'Connection': 'keep-alive', 'Accept-Encoding': 'gzip'}
+    # only genuinely historical windows are served from the on-disk
+    # cache: a window reaching into the last hour or the future keeps
+    # changing as readings and next-day rates are published, and caching
+    # it would pin every same-day re-run to the first response. the
+    # sqlite busy timeout covers the concurrent fetch threads sharing
+    # one cache file
+    cache_cutoff = datetime.now(timezone.utc) - timedelta(hours=1)
+    if parse_datetime(to_date) < cache_cutoff:
+        session = CachedSession(
+            cache=SQLiteBackend(
+                'octograph_cache', expire_after=86400,
+                allowed_methods=('GET',), timeout=30,
+            ),
+            connector=connector, headers=headers,
         )
+    else:
+        session = aiohttp.ClientSession(connector=connector, headers=headers)
+    async with session:
+        data = await fetch_page(session, semaphore, api_key, url, args)
+        results = data.get('results', [])
+        if data['next'] and results:
+            # total page count is known from the first page, so the
+            # remaining pages can be fetched concurrently
+            page_count = -(-data['count'] // len(results))
+            tasks = [
+                asyncio.create_task(fetch_page(
+                    session, semaphore, api_key, url, {**args, 'page': page}
+                ))
+                for page in range(2, page_count + 1)
+            ]
+            # append each page as it completes instead of holding every
+            # raw page payload until the gather resolves; ordering is
+            # irrelevant as every reading carries its own timestamp
+            for task in asyncio.as_completed(tasks):
+                page_data = await task
+                results.extend(page_data.get('results', []))
     return results
 
 
+def retrieve_paginated_data(api_key, url, from_date, to_date,
+                            page_size=1500):
+    return asyncio.run(
+        retrieve_paginated_data_async(
+            api_key, url, from_date, to_date, page_size
+        )
+    )
+
+
+@lru_cache(maxsize=1024)
+def parse_interval_end(interval_end):
+    return parse_datetime(interval_end)
+
+
+def minute_of_day(hhmm):
+    hours, minutes = hhmm.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+
 def store_series(connection, series, metrics, rate_data):
 
     agile_data = rate_data.get('agile_unit_rates', [])
+    # aware datetimes hash by instant, so keys match regardless of the
+    # UTC offset the API formatted either timestamp with
     agile_rates = {
-        point['valid_to']: point['value_inc_vat']
+        parse_datetime(point['valid_to']): point['value_inc_vat']
         for point in agile_data
     }
 
-    def active_rate_field(measurement):
+    low_zone = rate_data.get('unit_rate_low_zone')
+    if low_zone:
+        low_start_min = minute_of_day(rate_data['unit_rate_low_start'])
+        low_end_min = minute_of_day(rate_data['unit_rate_low_end'])
+    else:
+        low_start_min = low_end_min = None
+
+    def active_rate_field(interval_start):
         if series == 'gas':
             return 'unit_rate'
-        elif not rate_data['unit_rate_low_zone']:  # no low rate
+        elif not low_zone:  # no low rate
             return 'unit_rate_high'
 
-        low_start_str = rate_data['unit_rate_low_start']
-        low_end_str = rate_data['unit_rate_low_end']
-        low_zone = rate_data['unit_rate_low_zone']
-
-        measurement_at = maya.parse(measurement['interval_start'])
-
-        low_start = maya.when(
-            measurement_at.datetime(to_timezone=low_zone).strftime(
-                f'%Y-%m-%dT{low_start_str}'
-            ),
-            timezone=low_zone
-        )
-        low_end = maya.when(
-            measurement_at.datetime(to_timezone=low_zone).strftime(
-                f'%Y-%m-%dT{low_end_str}'
-            ),
-            timezone=low_zone
-        )
-        if low_start > low_end:
-            # end time is the following day
-            low_end_d1 = maya.when(
-                measurement_at.datetime(to_timezone=low_zone).strftime(
-                    f'%Y-%m-%dT23:59:59'
-                ),
-                timezone=low_zone
-            )
-            low_start_d2 = maya.when(
-                measurement_at.datetime(to_timezone=low_zone).strftime(
-                    f'%Y-%m-%dT00:00:00'
-                ),
-                timezone=low_zone
-            )
-            low_period_a = maya.MayaInterval(low_start, low_end_d1)
-            low_period_b = maya.MayaInterval(low_start_d2, low_end)
+        local = parse_datetime(interval_start).astimezone(low_zone)
+        minute = local.hour * 60 + local.minute
+        if low_start_min <= low_end_min:
+            is_low = low_start_min <= minute < low_end_min
         else:
-            low_period_a = low_period_b = maya.MayaInterval(low_start, low_end)
-        return \
-            'unit_rate_low' if measurement_at in low_period_a \
-                or measurement_at in low_period_b \
-            else 'unit_rate_high'
+            # low window wraps past midnight
+            is_low = minute >= low_start_min or minute < low_end_min
+        return 'unit_rate_low' if is_low else 'unit_rate_high'
 
-    def fields_for_measurement(measurement):
+    # default-argument binds hoist the loop-invariant lookups out of the
+    # per-measurement call into locals
+    def build_line(measurement,
+                   _series=series,
+                   _conversion_factor=rate_data.get('conversion_factor'),
+                   _has_agile=bool(agile_data),
+                   _agile_rates=agile_rates,
+                   _rate_data=rate_data,
+                   _active_rate_field=active_rate_field,
+                   _parse_interval_end=parse_interval_end,
+                   _utc=timezone.utc):
         consumption = measurement['consumption']
-        conversion_factor = rate_data.get('conversion_factor', None)
-        if conversion_factor:
-            consumption *= conversion_factor
-        rate = active_rate_field(measurement)
-        fields = {
-            'consumption': consumption,
-        }
-        if agile_data:
-            agile_unit_rate = agile_rates.get(
-                maya.parse(measurement['interval_end']).iso8601(),
-                rate_data[rate]  # cludge, use Go rate during DST changeover
+        if _conversion_factor:
+            consumption *= _conversion_factor
+        rate = _active_rate_field(measurement['interval_start'])
+        period = _parse_interval_end(measurement['interval_end'])
+        time_of_day = period.astimezone(_utc).strftime('%H:%M')
+        # interval boundaries are whole seconds, so scaling by integer
+        # nanoseconds avoids float rounding
+        timestamp = int(period.timestamp()) * 1_000_000_000
+        fields = f'consumption={consumption}'
+        if _has_agile:
+            agile_unit_rate = _agile_rates.get(
+                period,
+                _rate_data[rate]  # cludge, use Go rate during DST changeover
             )
-            agile_cost = agile_unit_rate * consumption
-            fields.update({
-                'agile_rate': agile_unit_rate,
-                'agile_cost': agile_cost,
-            })
-        return fields
-
-    def tags_for_measurement(measurement):
-        period = maya.parse(measurement['interval_end'])
-        time = period.datetime().strftime('%H:%M')
-        return {
-            'active_rate': active_rate_field(measurement),
-            'time_of_day': time,
-        }
+            fields += (
+                f',agile_rate={agile_unit_rate}'
+                f',agile_cost={agile_unit_rate * consumption}'
+            )
+        return (
+            f'{_series},active_rate={rate},time_of_day={time_of_day} '
+            f'{fields} {timestamp}'
+        )
 
-    measurements = [
-        {
-            'measurement': series,
-            'tags': tags_for_measurement(measurement),
-            'time': measurement['interval_end'],
-            'fields': fields_for_measurement(measurement),
-        }
-        for measurement in metrics
-    ]
-    write_api = connection.write_api(write_options=SYNCHRONOUS)
+    write_api = connection.write_api(
+        write_options=WriteOptions(batch_size=500, flush_interval=10_000)
+    )
+
+    lines = []
+    written = 0
+    for measurement in metrics:
+        log.debug("measurement for %s", measurement['interval_end'])
+        lines.append(build_line(measurement))
+        if len(lines) >= 500:
+            write_api.write(bucket="energy", record='\n'.join(lines))
+            written += len(lines)
+            lines = []
 
-    for measurement in measurements:
-        print(f"Measurement for {measurement['time']}:\n")
-        for field in measurement['fields']:
-            print(f"\tField: {field}:{measurement['fields'][field]}")
-            point = Point("electricity").field(field, measurement['fields'][field]).time(measurement['time'])
-            write_api.write(bucket="energy", record=point)
+    if lines:
+        write_api.write(bucket="energy", record='\n'.join(lines))
+        written += len(lines)
+    write_api.close()
+    log.info("wrote %d %s points", written, series)
 
 
 
@@ -146,7 +214,8 @@ def store_series(connection, series, metrics, rate_data):
 @click.option('--from-date', default='yesterday midnight', type=click.STRING)
 @click.option('--to-date', default='today midnight', type=click.STRING)
 @click.option('--no-gas', default=False, type=click.BOOL)
-def cmd(config_file, from_date, to_date, no_gas):
+@click.option('--page-size', default=1500, type=click.INT)
+def cmd(config_file, from_date, to_date, no_gas, page_size):
 
     config = ConfigParser()
     config.read(config_file)
@@ -176,7 +245,12 @@ def cmd(config_file, from_date, to_date, no_gas):
     g_url = 'https://api.octopus.energy/v1/gas-meter-points/' \
             f'{g_mpan}/meters/{g_serial}/consumption/'
 
-    timezone = config.get('electricity', 'unit_rate_low_zone', fallback=None)
+    timezone_name = config.get(
+        'electricity', 'unit_rate_low_zone', fallback=None
+    )
+    # resolve the timezone once; every per-measurement calculation
+    # reuses the object instead of re-looking the name up in tzdata
+    low_zone = ZoneInfo(timezone_name) if timezone_name else None
 
     rate_data = {
         'electricity': {
@@ -195,7 +269,7 @@ def cmd(config_file, from_date, to_date, no_gas):
             'unit_rate_low_end': config.get(
                 'electricity', 'unit_rate_low_end', fallback="00:00"
             ),
-            'unit_rate_low_zone': timezone,
+            'unit_rate_low_zone': low_zone,
             'agile_standing_charge': config.getfloat(
                 'electricity', 'agile_standing_charge', fallback=0.0
             ),
@@ -211,31 +285,36 @@ def cmd(config_file, from_date, to_date, no_gas):
         }
     }
 
-    from_iso = maya.when(from_date, timezone=timezone).iso8601()
-    to_iso = maya.when(to_date, timezone=timezone).iso8601()
+    from_iso = maya.when(from_date, timezone=timezone_name).iso8601()
+    to_iso = maya.when(to_date, timezone=timezone_name).iso8601()
 
-    click.echo(
-        f'Retrieving electricity data for {from_iso} until {to_iso}...',
-        nl=False
-    )
-    e_consumption = retrieve_paginated_data(api_key, e_url, from_iso, to_iso )
-    click.echo(f' {len(e_consumption)} readings.')
-    click.echo(
-        f'Retrieving Agile rates for {from_iso} until {to_iso}...',
-        nl=False
-    )
-    rate_data['electricity']['agile_unit_rates'] = retrieve_paginated_data( api_key, agile_url, from_iso, to_iso)
-    click.echo(f' {len(rate_data["electricity"]["agile_unit_rates"])} rates.')
-  #  click.echo(rate_data["electricity"]["agile_unit_rates"])
+    click.echo(f'Retrieving data for {from_iso} until {to_iso}...')
+    # the three endpoints are independent, so fetch them concurrently;
+    # each worker runs its own event loop via the sync wrapper
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        e_future = executor.submit(
+            retrieve_paginated_data, api_key, e_url, from_iso, to_iso,
+            page_size
+        )
+        agile_future = executor.submit(
+            retrieve_paginated_data, api_key, agile_url, from_iso, to_iso,
+            page_size
+        )
+        g_future = executor.submit(
+            retrieve_paginated_data, api_key, g_url, from_iso, to_iso,
+            page_size
+        ) if no_gas == False else None
+
+        e_consumption = e_future.result()
+        rate_data['electricity']['agile_unit_rates'] = agile_future.result()
+        g_consumption = g_future.result() if g_future else None
+
+    click.echo(f'{len(e_consumption)} electricity readings.')
+    click.echo(f'{len(rate_data["electricity"]["agile_unit_rates"])} rates.')
     store_series(influx, 'electricity', e_consumption, rate_data['electricity'])
 
-    if no_gas == False:
-        click.echo(
-            f'Retrieving gas data for {from_iso} until {to_iso}...',
-            nl=False
-        )
-        g_consumption = retrieve_paginated_data(api_key, g_url, from_iso, to_iso)
-        click.echo(f' {len(g_consumption)} readings.')
+    if g_consumption is not None:
+        click.echo(f'{len(g_consumption)} gas readings.')
         store_series(influx, 'gas', g_consumption, rate_data['gas'])
 
 